@@ -7,13 +7,27 @@ Author: Tanmay Sinnarkar (tanmay.sinnarkar@bedbath.com)
 
 
 from google.oauth2 import service_account
+from google.api_core.exceptions import GoogleAPIError, PermissionDenied
 from google.cloud import bigquery
 from google.cloud import bigquery_storage
+from google.cloud.bigquery_storage_v1.services.big_query_read.transports \
+    import BigQueryReadGrpcTransport
+from google.cloud import storage
+import pyarrow as pa
+import pyarrow.parquet as pq
 import pandas as pd
 import numpy as np
 from sklearn.ensemble import ExtraTreesClassifier
 import pickle
+import joblib
 import logging
+import functools
+import os
+import re
+import string
+import threading
+import uuid
+from collections.abc import Mapping
 from datetime import date
 
 
@@ -21,127 +35,301 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 key_path = '/home/jupyter/d00_key.json'
-credentials = service_account.Credentials.from_service_account_file(
-    key_path,
-    scopes=["https://www.googleapis.com/auth/cloud-platform"],
+
+INPUT_TABLE = 'dw-bq-data-d00.SANDBOX_ANALYTICS.TTS_Production'
+OUTPUT_DATASET = 'SANDBOX_ANALYTICS'
+OUTPUT_TABLE = 'time_to_shop'
+QUERY_TEMPLATE = string.Template('SELECT * FROM `${input_table}`')
+
+GCP_SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+
+# Interior decile cut points; P in (edge[k-1], edge[k]] falls in bucket k.
+DECILE_BINS_ARR = np.asarray([
+    0.19662877, 0.21054794, 0.25123934, 0.26712146, 0.42682036, 0.493293,
+    0.59348687, 0.67486295, 0.77079006
+], dtype=np.float64)
+DECILE_LABELS_INT = np.array([10, 9, 8, 7, 6, 5, 4, 3, 2, 1], dtype=np.int8)
+
+DECILE_COL_RE = re.compile(r'DECILE')
+RECENCY_COL_RE = re.compile(r'_R')
+
+FEATURE_COLUMNS = (
+    'SALES_6M', 'FREQUENCY_6M', 'BUYS_Q_03', 'COUPON_Q_03',
+    'PH_MREDEEM90D', 'PH_PFREQ90D', 'PH_CFREQ90D',
+    'BBB_INSTORE_RFM_DECILE', 'BBB_ECOM_R_DECILE',
+    'BBB_OFFCOUPON_RFM_DECILE', 'NUM_PERIODS', 'NUM_PRODUCT_GROUPS',
+    'PRESENCE_OF_CHILD', 'MARITAL_STAT'
 )
 
+PREDICT_BATCH_ROWS = 100_000
+
+# Results smaller than this are paged over REST instead of opening a
+# Storage read session.
+INLINE_RESULT_ROWS = 50_000
+
+OUTPUT_TABLE_SCHEMA = [
+    {'name': 'CUSTOMER_ID', 'field_type': 'INTEGER'},
+    {'name': 'PREVIOUS_PURCHASE', 'field_type': 'DATETIME'},
+    {'name': 'DECILE', 'field_type': 'INTEGER'},
+    {'name': 'P', 'field_type': 'FLOAT'},
+]
+_BQ_TO_ARROW = {
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+    'DATETIME': pa.timestamp('us'),
+}
+OUTPUT_BQ_SCHEMA = tuple(
+    bigquery.SchemaField(**field) for field in OUTPUT_TABLE_SCHEMA)
+OUTPUT_ARROW_SCHEMA = pa.schema(
+    [(field['name'], _BQ_TO_ARROW[field['field_type']])
+     for field in OUTPUT_TABLE_SCHEMA])
+
+GCS_UPLOAD_CHUNK_BYTES = 100 * 1024 * 1024
+
+# Larger HTTP/2 frames for read streams; keepalive pings are only sent
+# while a stream is active.
+STORAGE_GRPC_OPTIONS = [
+    ('grpc.max_send_message_length', -1),
+    ('grpc.max_receive_message_length', -1),
+    ('grpc.http2.max_frame_size', 16777215),
+    ('grpc.keepalive_time_ms', 30000),
+]
+
+WRITE_DISPOSITIONS = {
+    'append': bigquery.WriteDisposition.WRITE_APPEND,
+    'replace': bigquery.WriteDisposition.WRITE_TRUNCATE,
+    'fail': bigquery.WriteDisposition.WRITE_EMPTY,
+}
+
+
+_CLIENT_CACHE = {}
+_GCS_CLIENT_CACHE = {}
+_CLIENT_LOCK = threading.Lock()
+_storage_read_disabled = False
+
+
+@functools.lru_cache(maxsize=8)
+def _load_service_account(path, scopes):
+    return service_account.Credentials.from_service_account_file(
+        path,
+        scopes=list(scopes),
+    )
+
+
+def get_credentials(path=None, scopes=GCP_SCOPES):
+    return _load_service_account(path or key_path, tuple(sorted(set(scopes))))
+
+
+def _client_cache_key(credentials):
+    return (credentials.service_account_email, credentials.project_id,
+            tuple(sorted(credentials.scopes or ())))
+
 
 def get_client(credentials):
-   
-    bq_client = bigquery.Client(credentials=credentials,
-                                project=credentials.project_id)
-    bqstorageclient = bigquery_storage.BigQueryReadClient(
-        credentials=credentials)
-    return bq_client, bqstorageclient
-
-
-def copy_results_to_bq(data, output_name, credentials):
-    bq_client, bqstorageclient = get_client(credentials=credentials)
-    logging.info("Copying results to BQ...")
-    data.to_gbq(destination_table=f'SANDBOX_ANALYTICS.{output_name}',
-                project_id=credentials.project_id,
-                if_exists='append',
-                table_schema=[ 
-                               {'name': 'CUSTOMER_ID','type': 'INTEGER'},
-                               {'name': 'PREVIOUS_PURCHASE','type': 'DATETIME'},
-                               {'name': 'DECILE','type': 'INTEGER'},
-                               {'name': 'P','type': 'FLOAT'}],
-                credentials=credentials)
-    logging.info("Results exported successfully.")
-    
+    cache_key = _client_cache_key(credentials)
+    clients = _CLIENT_CACHE.get(cache_key)
+    if clients is None:
+        with _CLIENT_LOCK:
+            clients = _CLIENT_CACHE.get(cache_key)
+            if clients is None:
+                bq_client = bigquery.Client(credentials=credentials,
+                                            project=credentials.project_id)
+                channel = BigQueryReadGrpcTransport.create_channel(
+                    credentials=credentials, options=STORAGE_GRPC_OPTIONS)
+                bqstorageclient = bigquery_storage.BigQueryReadClient(
+                    transport=BigQueryReadGrpcTransport(channel=channel))
+                clients = _CLIENT_CACHE[cache_key] = (bq_client,
+                                                      bqstorageclient)
+    return clients
+
+
+def get_gcs_client(credentials):
+    cache_key = _client_cache_key(credentials)
+    gcs_client = _GCS_CLIENT_CACHE.get(cache_key)
+    if gcs_client is None:
+        with _CLIENT_LOCK:
+            gcs_client = _GCS_CLIENT_CACHE.get(cache_key)
+            if gcs_client is None:
+                gcs_client = _GCS_CLIENT_CACHE[cache_key] = storage.Client(
+                    credentials=credentials, project=credentials.project_id)
+    return gcs_client
+
 
-def data_upload(QUERY):
-    key_path = '/home/jupyter/d00_key.json'
-    credentials = service_account.Credentials.from_service_account_file(
-        key_path,
-        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+def copy_results_to_bq(data, output_name, credentials, if_exists='append',
+                       staging_bucket=None):
+    bq_client, bqstorageclient = get_client(credentials)
+    logging.info("Copying %d results to BQ...", len(data))
+    table_id = f'{credentials.project_id}.{OUTPUT_DATASET}.{output_name}'
+    job_config = bigquery.LoadJobConfig(
+        schema=OUTPUT_BQ_SCHEMA,
+        write_disposition=WRITE_DISPOSITIONS[if_exists],
+        source_format=bigquery.SourceFormat.PARQUET,
     )
+    table = pa.Table.from_pandas(data, schema=OUTPUT_ARROW_SCHEMA,
+                                 preserve_index=False)
+    if staging_bucket:
+        blob = stage_parquet_to_gcs(table, staging_bucket, output_name,
+                                    credentials)
+        try:
+            job = bq_client.load_table_from_uri(
+                f'gs://{blob.bucket.name}/{blob.name}', table_id,
+                job_config=job_config)
+            job.result()
+        finally:
+            try:
+                blob.delete()
+            except GoogleAPIError:
+                logging.warning("Could not delete staging file gs://%s/%s",
+                                blob.bucket.name, blob.name, exc_info=True)
+    else:
+        buf = pa.BufferOutputStream()
+        pq.write_table(table, buf)
+        job = bq_client.load_table_from_file(
+            pa.BufferReader(buf.getvalue()), table_id, job_config=job_config)
+        job.result()
+    logging.info("Results exported successfully.")
+
 
-    bq_client = bigquery.Client(credentials=credentials,
-                                project=credentials.project_id)
-    bqstorageclient = bigquery_storage.BigQueryReadClient(
-        credentials=credentials)
+def stage_parquet_to_gcs(table, bucket_name, output_name, credentials):
+    gcs_client = get_gcs_client(credentials)
+    blob_name = (f'staging/{output_name}/'
+                 f'{date.today():%Y%m%d}-{uuid.uuid4().hex}.parquet')
+    blob = gcs_client.bucket(bucket_name).blob(blob_name)
+    with blob.open('wb', chunk_size=GCS_UPLOAD_CHUNK_BYTES) as f:
+        pq.write_table(table, f)
+    return blob
 
-    data = bq_client.query(QUERY).result().to_dataframe(
-        bqstorage_client=bqstorageclient)
 
-    for col in data.columns:
-        if 'DECILE' in col:
-            data[col].fillna(11, inplace=True)
-        elif '_R' in col and 'DECILE' not in col:
-            data[col].fillna(366, inplace=True)
+@functools.lru_cache(maxsize=8)
+def _fill_map(columns):
+    fill_map = {}
+    for col in columns:
+        if DECILE_COL_RE.search(col):
+            fill_map[col] = 11
+        elif RECENCY_COL_RE.search(col):
+            fill_map[col] = 366
         else:
-            data[col].fillna(0, inplace=True)
-    data.SALES_6M.loc[data.SALES_6M < 0] = 0
-    data.COUPON_EXPENSE_6M.loc[data.COUPON_EXPENSE_6M < 0] = 0
+            fill_map[col] = 0
+    return fill_map
+
+
+def _rerun_rows(bq_client, QUERY, job, rows):
+    # A RowIterator cannot be read twice, so fetch the results again.
+    if job is None and getattr(rows, 'job_id', None):
+        job = bq_client.get_job(rows.job_id, project=rows.project,
+                                location=rows.location)
+    if job is None:
+        return bq_client.query(QUERY).result()
+    return job.result()
+
 
-    key = ['CUSTOMER_ID', 'ADDRESS_ID']
-    data[key] = data[key].astype("object")
+def data_upload(QUERY, bq_client, bqstorageclient):
+    global _storage_read_disabled
+    if isinstance(QUERY, Mapping):
+        QUERY = QUERY_TEMPLATE.substitute(QUERY)
+    job = None
+    if hasattr(bq_client, 'query_and_wait'):
+        rows = bq_client.query_and_wait(QUERY)
+    else:
+        job = bq_client.query(QUERY)
+        rows = job.result()
+    if rows.total_rows is not None and rows.total_rows < INLINE_RESULT_ROWS:
+        bqstorageclient = None
+    if _storage_read_disabled:
+        bqstorageclient = None
+    try:
+        table = rows.to_arrow(bqstorage_client=bqstorageclient,
+                              create_bqstorage_client=False)
+    except PermissionDenied:
+        logging.warning("No readsessions.create permission; "
+                        "falling back to REST reads for this process.")
+        _storage_read_disabled = True
+        rows = _rerun_rows(bq_client, QUERY, job, rows)
+        table = rows.to_arrow(create_bqstorage_client=False)
+    logging.info("Query completed. Retrieved %d rows.", table.num_rows)
+    data = table.to_pandas(self_destruct=True, split_blocks=True,
+                           date_as_object=False)
+    del table
+
+    data.fillna(_fill_map(tuple(data.columns)), inplace=True)
+    data['SALES_6M'] = data['SALES_6M'].clip(lower=0)
+    data['COUPON_EXPENSE_6M'] = data['COUPON_EXPENSE_6M'].clip(lower=0)
+
+    key = ['ADDRESS_ID']
     key1 = [
         'SALES_6M', 'COUPON_EXPENSE_6M', 'BUYS_Q_03', 'COUPON_Q_03',
         'PH_MREDEEM90D', 'PH_PFREQ90D', 'PH_CFREQ90D',
         'BBB_INSTORE_RFM_DECILE', 'BBB_ECOM_R_DECILE',
         'BBB_OFFCOUPON_RFM_DECILE', 'PCT_TXNS_ON_MKD_DISC'
     ]
-    data[key1] = data[key1].astype('int')
+    cast_map = {'CUSTOMER_ID': 'int64'}
+    cast_map.update({col: 'object' for col in key})
+    cast_map.update({col: 'int32' for col in key1})
+    data = data.astype(cast_map, copy=False)
     return data
 
 
-def extratrees_predict(data, model):
+@functools.lru_cache(maxsize=1)
+def _load_model_file(model_path, mtime):
+    # mmap only trims the peak read: sklearn's Tree.__setstate__ copies the
+    # node and value arrays into its own buffers, so nothing stays mapped.
+    if model_path.endswith('.joblib'):
+        return joblib.load(model_path, mmap_mode='r')
+    with open(model_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_model(model_path):
+    model = _load_model_file(model_path, os.path.getmtime(model_path))
+    try:
+        model.set_params(n_jobs=-1, verbose=0)
+    except ValueError:
+        pass
+    n_jobs = getattr(model, 'n_jobs', None)
+    logging.info("Model loaded with n_jobs=%s",
+                 joblib.effective_n_jobs(n_jobs) if n_jobs else n_jobs)
+    return model
+
+
+def extratrees_predict(data, model, batch_size=PREDICT_BATCH_ROWS):
     """
     Objective: To predict the likelihood of Bed Bath Customer making their next purchase     within 90 days from the day they made their last purchase.
 
     Author: Tanmay Sinnarkar (tanmay.sinnarkar@bedbath.com)
 
     """
-    Score1 = data[[
-        'SALES_6M', 'FREQUENCY_6M', 'BUYS_Q_03', 'COUPON_Q_03',
-        'PH_MREDEEM90D', 'PH_PFREQ90D', 'PH_CFREQ90D',
-        'BBB_INSTORE_RFM_DECILE', 'BBB_ECOM_R_DECILE',
-        'BBB_OFFCOUPON_RFM_DECILE', 'NUM_PERIODS', 'NUM_PRODUCT_GROUPS',
-        'PRESENCE_OF_CHILD', 'MARITAL_STAT'
-    ]]
-    predicted = model.predict(Score1)
-
-    predicted_df = pd.DataFrame(data=predicted,
-                                columns=['y_hat'],
-                                index=data.index.copy())
-    probn = model.predict_proba(Score1)
-
-    prob1 = probn[:, 1]
-    prob0 = probn[:, 0]
-    Proba = pd.DataFrame(data=prob1, columns=['P'], index=data.index.copy())
-    df_out1 = pd.merge(data[['CUSTOMER_ID', 'PREVIOUS_PURCHASE']],
-                       Proba,
-                       how='left',
-                       left_index=True,
-                       right_index=True)
-    cut_labels_10 = ['10', '9', '8', '7', '6', '5', '4', '3', '2', '1']
-
-    cut_bins = [
-        0.00, 0.19662877, 0.21054794, 0.25123934, 0.26712146, 0.42682036,
-        0.493293, 0.59348687, 0.67486295, 0.77079006, 1
-    ]
-    df_out1['DECILE'] = pd.cut(df_out1['P'],
-                               bins=cut_bins,
-                               labels=cut_labels_10)
+    feature_iloc = data.columns.get_indexer(FEATURE_COLUMNS)
+    if (feature_iloc < 0).any():
+        missing = [c for c, i in zip(FEATURE_COLUMNS, feature_iloc) if i < 0]
+        raise KeyError(f"Missing feature columns: {missing}")
+    X = np.ascontiguousarray(
+        data.iloc[:, feature_iloc].to_numpy(dtype=np.float32))
+    prob1 = np.empty(len(X), dtype=np.float64)
+    for start in range(0, len(X), batch_size):
+        stop = start + batch_size
+        prob1[start:stop] = model.predict_proba(X[start:stop])[:, 1]
+    df_out1 = pd.DataFrame(
+        {
+            'CUSTOMER_ID': data['CUSTOMER_ID'].to_numpy(),
+            'PREVIOUS_PURCHASE': data['PREVIOUS_PURCHASE'].to_numpy(),
+            'P': prob1,
+        },
+        index=data.index)
+    codes = np.searchsorted(DECILE_BINS_ARR, prob1, side='left')
+    df_out1['DECILE'] = DECILE_LABELS_INT[codes]
     return df_out1
 
 
 
 def main():
-    QUERY = """SELECT * FROM `dw-bq-data-d00.SANDBOX_ANALYTICS.TTS_Production`"""
-    model = pickle.load(open('finalized_model.sav', 'rb'))
-    data = data_upload(QUERY)
+    QUERY = {'input_table': INPUT_TABLE}
+    model = load_model('finalized_model.sav')
+    credentials = get_credentials()
+    bq_client, bqstorageclient = get_client(credentials)
+    data = data_upload(QUERY, bq_client, bqstorageclient)
     output = extratrees_predict(data, model)
     output.reset_index(drop=True, inplace=True)
-    output['CUSTOMER_ID'] = output['CUSTOMER_ID'].astype(int)
-    output['PREVIOUS_PURCHASE']=pd.to_datetime(output['PREVIOUS_PURCHASE'])
-    output['DECILE'] = output['DECILE'].astype(int)
-    output['P'] = output['P'].astype(float)
-    output_name = 'time_to_shop'
-    copy_results_to_bq(output, output_name, credentials)
+    copy_results_to_bq(output, OUTPUT_TABLE, credentials)
 
 
 if __name__ == "__main__":